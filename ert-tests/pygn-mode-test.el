@@ -2095,6 +2095,42 @@
                            fen-for-move)))
           (setq last-pos (1- move-pos)))))))
 
+;;; pygn-mode-pgn-to-fen
+
+(ert-deftest pygn-mode-pgn-to-fen-01 nil
+  "Test `pygn-mode-pgn-to-fen' on one game as it is edited, against a freshly started server for each edit."
+  (let* ((headers "[Event \"?\"]\n[Site \"?\"]\n[Result \"*\"]\n\n")
+         (pgns (list
+                ;; extended, truncated, and extended again
+                (concat headers "1. e4 e5 2. Nf3 Nc6 3. Bb5 a6")
+                (concat headers "1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4 Nf6 5. O-O Be7")
+                (concat headers "1. e4 e5 2. Nf3")
+                (concat headers "1. e4 e5 2. Nf3 Nc6 3. Bb5 a6 4. Ba4")
+                ;; a mid-game move edited
+                (concat headers "1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. c3")
+                ;; whitespace only
+                (concat headers "1. e4  e5\n2. Nf3 Nc6 3. Bc4 Bc5 4. c3")
+                ;; an illegal move appended, then moves after it, then replaced
+                (concat headers "1. e4  e5\n2. Nf3 Nc6 3. Bc4 Bc5 4. c3 Ke6")
+                (concat headers "1. e4  e5\n2. Nf3 Nc6 3. Bc4 Bc5 4. c3 Ke6 5. d4")
+                (concat headers "1. e4  e5\n2. Nf3 Nc6 3. Bc4 Bc5 4. c3 Nf6")
+                ;; a result and a comment
+                (concat headers "1. e4  e5\n2. Nf3 Nc6 3. Bc4 Bc5 4. c3 Nf6 1-0")
+                (concat headers "1. e4  e5\n2. Nf3 Nc6 3. Bc4 {Italian} Bc5 4. c3 Nf6")
+                ;; different headers
+                (concat "[Event \"?\"]\n[SetUp \"1\"]\n"
+                        "[FEN \"r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3\"]\n"
+                        "[Result \"*\"]\n\n"
+                        "3. Bc4 Bc5 4. c3 Nf6")
+                ;; no moves, then a first move
+                headers
+                (concat headers "1. d4")))
+         (fens (mapcar #'pygn-mode-pgn-to-fen pgns)))
+    (cl-mapc (lambda (pgn fen)
+               (pygn-mode--server-kill)
+               (should (equal (pygn-mode-pgn-to-fen pgn) fen)))
+             pgns fens)))
+
 ;;; pygn-mode-next-move
 
 (ert-deftest pygn-mode-next-move-01 nil
@@ -26,12 +26,16 @@ __version__ = '0.6.3'
 ###
 
 import sys
-import argparse
+import os
 import signal
 import io
 import re
 import atexit
 import shlex
+import collections
+import functools
+import threading
+import types
 
 import chess.pgn
 import chess.svg
@@ -42,66 +46,358 @@ import chess.engine
 ###
 
 ENGINES = {}
+# Serializes starting and searching with each engine, by engine path, between
+# requests and the prewarm threads.
+ENGINE_LOCKS = {}
+# Guards ENGINES, ENGINE_LOCKS, and ENGINES_CLOSED, and is only held briefly.
+ENGINES_LOCK = threading.Lock()
+# Set by cleanup(), after which newly started engines are quit, not kept.
+ENGINES_CLOSED = False
+
+# Engines to start in the background when the server starts, separated by
+# os.pathsep.
+PREWARM_ENGINES_VARIABLE = 'PYGN_MODE_PREWARM_ENGINES'
+
+# UCI options set once per engine, where the engine supports them, so that its
+# hash table is large enough to carry over between requests.
+ENGINE_OPTIONS = {
+    'Hash': 512,
+    'Threads': max(1, (os.cpu_count() or 1) // 2),
+}
+
+# Engine scores by (engine path, depth, position), least recently used first.
+SCORE_CACHE = collections.OrderedDict()
+SCORE_CACHE_SIZE = 1024
+
+# State of the most recent replay.  When the next request shares the same
+# headers and differs only in moves at the end of the movetext, the cached
+# board is rewound and extended instead of replaying every move.
+LAST_PGN_TEXT = None
+LAST_MOVETEXT_START = None
+LAST_HEADERS = None
+LAST_BOARD = None
+LAST_MOVE = False
+LAST_FEN = None
+
+# FENs of the cached board's positions, indexed by ply, or None where not
+# yet computed.  Entries before the point where two requests diverge stay
+# valid, so stepping back and forth through a game rarely calls board.fen().
+LAST_FENS = []
+
+# Input buffer for the PGN parser, rewritten for every full replay.
+PGN_IO = io.StringIO()
+
+PGN_HEADERS_REGEX = re.compile(r'\A(?:[ \t\r]*\n)*(?:\[.*\n(?:[ \t\r]*\n)?)*')
+SIMPLE_MOVETEXT_REGEX = re.compile(r'\A[\sa-hnrqkNBRQKOx0-9.=+#\-]*\Z')
+BLANK_LINE_REGEX = re.compile(r'^[ \t\r]*\n', re.MULTILINE)
+TRAILING_TOKEN_REGEX = re.compile(r'\S*\Z')
+
+REQUEST_REGEX = re.compile(r'\A:version\s+(\S+)\s+(:\S+)(.*?)\s+--\s+(:\S+)\s+(\S.*)\n')
+SVG_NEWLINE_REGEX = re.compile(r'\r?\n')
+OPTIONS_QUOTING_REGEX = re.compile(r'[\'"\\]')
+
+# Borders of the text board, escaped for the single-line response.
+BOARD_TEXT_TOP = '  ┌───┬───┬───┬───┬───┬───┬───┬───┐'.encode()
+BOARD_TEXT_MIDDLE = '\\n  ├───┼───┼───┼───┼───┼───┼───┼───┤'.encode()
+BOARD_TEXT_BOTTOM = '\\n  └───┴───┴───┴───┴───┴───┴───┴───┘\\n    a   b   c   d   e   f   g   h'.encode()
+BOARD_TEXT_CELL = ' │ '.encode()
 
 ###
 ### subroutines
 ###
 
+def engine_lock(engine_path):
+    with ENGINES_LOCK:
+        if not engine_path in ENGINE_LOCKS:
+            ENGINE_LOCKS[engine_path] = threading.RLock()
+        return ENGINE_LOCKS[engine_path]
+
 def instantiate_engine(engine_path):
-    if not engine_path in ENGINES:
-        ENGINES[engine_path] = chess.engine.SimpleEngine.popen_uci(engine_path)
-    return ENGINES[engine_path]
+    with engine_lock(engine_path):
+        with ENGINES_LOCK:
+            engine = ENGINES.get(engine_path)
+        if engine is None:
+            engine = chess.engine.SimpleEngine.popen_uci(engine_path)
+            options = {}
+            for name, value in ENGINE_OPTIONS.items():
+                if name in engine.options:
+                    option = engine.options[name]
+                    if option.max is not None:
+                        value = min(value, option.max)
+                    options[name] = value
+            engine.configure(options)
+            with ENGINES_LOCK:
+                closed = ENGINES_CLOSED
+                if not closed:
+                    ENGINES[engine_path] = engine
+            if closed:
+                engine.quit()
+                raise RuntimeError('server is shutting down')
+        return engine
+
+def prewarm_engine(engine_path):
+    """
+    Start an engine and run a shallow search, so that its process is running
+    and its hash table allocated before the first request.
+    """
+    try:
+        with engine_lock(engine_path):
+            engine = instantiate_engine(engine_path)
+            engine.analyse(chess.Board(), chess.engine.Limit(depth=1))
+    except Exception as e:
+        sys.stderr.write(f'Could not prewarm engine {engine_path}: {e}\n')
+
+def prewarm_engines():
+    for engine_path in os.environ.get(PREWARM_ENGINES_VARIABLE, '').split(os.pathsep):
+        if engine_path:
+            threading.Thread(target=prewarm_engine, args=(engine_path,), daemon=True).start()
 
 def cleanup():
-    for e in ENGINES.values():
+    global ENGINES_CLOSED
+    with ENGINES_LOCK:
+        ENGINES_CLOSED = True
+        engines = list(ENGINES.values())
+    for e in engines:
         try:
             e.quit()
         except:
             pass
 
-def pgn_to_board_callback(_game,board,last_move,last_fen,args):
-    if args.board_format[0] == 'svg':
-        svg = chess.svg.board(board=board,
-                              lastmove=last_move,
-                              size=args.pixels[0],
-                              flipped=args.flipped)
-        svg = re.sub(r'\r?\n', r' ', svg)
+class MainlineVisitor(chess.pgn.BaseVisitor):
+    """
+    Visitor which keeps the parser's board at the end of the mainline, without
+    building a game tree.  Variations, comments, and NAGs are discarded.
+    """
+    def begin_game(self):
+        self.headers = chess.pgn.Headers()
+        self.board = None
+        self.errors = []
+
+    def begin_headers(self):
+        return self.headers
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def visit_board(self, board):
+        # The parser pushes every mainline move onto this same board.
+        self.board = board
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_result(self, result):
+        if self.headers.get('Result', '*') == '*':
+            self.headers['Result'] = result
+
+    def handle_error(self, error):
+        chess.pgn.LOGGER.error('%s while parsing %r', error, self.headers)
+        self.errors.append(error)
+
+    def result(self):
+        return self
+
+# The parser asks for a new visitor for every game.  begin_game() resets all of
+# the visitor's state, so a single instance serves every request.
+MAINLINE_VISITOR = MainlineVisitor()
+
+def mainline_visitor():
+    return MAINLINE_VISITOR
+
+def movetext_moves(movetext):
+    """
+    Return the move tokens of movetext, or None unless movetext is a plain
+    sequence of move numbers and moves, read by the PGN parser as one mainline.
+    """
+    if not SIMPLE_MOVETEXT_REGEX.match(movetext) or BLANK_LINE_REGEX.search(movetext.rstrip()):
+        return None
+    moves = []
+    for match in chess.pgn.MOVETEXT_REGEX.finditer(movetext):
+        if match.lastindex != 1:
+            return None
+        moves.append(match.group(0))
+    return moves
+
+def board_fen(board):
+    """
+    Return board.fen(), taken from LAST_FENS when board is the cached board.
+    """
+    if board is not LAST_BOARD:
+        return board.fen()
+    ply = len(board.move_stack)
+    if LAST_FENS[ply] is None:
+        LAST_FENS[ply] = board.fen()
+    return LAST_FENS[ply]
+
+def last_move_and_fen(board):
+    """
+    Return the last move on the cached board and the FEN before it was played.
+    """
+    if not board.move_stack:
+        return False, board_fen(board)
+    last_move = board.peek()
+    ply = len(board.move_stack) - 1
+    if LAST_FENS[ply] is None:
+        board.pop()
+        LAST_FENS[ply] = board.fen()
+        board.push(last_move)
+    return last_move, LAST_FENS[ply]
+
+def replay_full(pgn):
+    global LAST_PGN_TEXT, LAST_MOVETEXT_START, LAST_HEADERS, LAST_BOARD, LAST_MOVE, LAST_FEN, LAST_FENS
+    PGN_IO.seek(0)
+    PGN_IO.truncate()
+    PGN_IO.write(pgn)
+    PGN_IO.seek(0)
+    line = chess.pgn.read_game(PGN_IO, Visitor=mainline_visitor)
+    board = line.board
+
+    # Only a movetext which parsed cleanly into exactly its own tokens can be
+    # extended later; anything else is cached for identical requests only.
+    movetext_start = PGN_HEADERS_REGEX.match(pgn).end()
+    moves = movetext_moves(pgn[movetext_start:])
+    if line.errors or moves is None or len(moves) != len(board.move_stack):
+        movetext_start = None
+
+    LAST_PGN_TEXT = pgn
+    LAST_MOVETEXT_START = movetext_start
+    LAST_HEADERS = line.headers
+    LAST_BOARD = board
+    LAST_FENS = [None] * (len(board.move_stack) + 1)
+    last_move, last_fen = last_move_and_fen(board)
+    LAST_MOVE = last_move
+    LAST_FEN = last_fen
+    return line.headers, board, last_move, last_fen
+
+def replay_incremental(pgn):
+    """
+    Rewind and extend the cached replay to match pgn.  Return None when pgn
+    cannot be reached from the cache by popping and pushing mainline moves.
+    """
+    global LAST_PGN_TEXT, LAST_MOVE, LAST_FEN
+    if LAST_PGN_TEXT is None:
+        return None
+    if pgn == LAST_PGN_TEXT:
+        return LAST_HEADERS, LAST_BOARD, LAST_MOVE, LAST_FEN
+    if LAST_MOVETEXT_START is None:
+        return None
+
+    # Cut the shared text back to a whitespace boundary, so that only whole
+    # tokens differ.
+    prefix = os.path.commonprefix([LAST_PGN_TEXT, pgn])
+    keep = TRAILING_TOKEN_REGEX.search(prefix).start()
+    if keep < LAST_MOVETEXT_START or movetext_moves(pgn[LAST_MOVETEXT_START:]) is None:
+        return None
+    dropped = movetext_moves(LAST_PGN_TEXT[keep:])
+    added = movetext_moves(pgn[keep:])
+    if dropped is None or added is None:
+        return None
+
+    # The cache is inconsistent until the update completes.
+    LAST_PGN_TEXT = None
+    board = LAST_BOARD
+    for _ in dropped:
+        board.pop()
+    del LAST_FENS[len(board.move_stack) + 1:]
+    for san in added:
+        board.push_san(san)
+        LAST_FENS.append(None)
+    last_move, last_fen = last_move_and_fen(board)
+
+    LAST_PGN_TEXT = pgn
+    LAST_MOVE = last_move
+    LAST_FEN = last_fen
+    return LAST_HEADERS, board, last_move, last_fen
+
+def replay_pgn(pgn):
+    """
+    Return the headers, final board, last move, and FEN before the last move
+    for pgn, reusing the previous replay where possible.
+    """
+    try:
+        replayed = replay_incremental(pgn)
+    except ValueError:
+        replayed = None
+    if replayed is None:
+        replayed = replay_full(pgn)
+    return replayed
+
+@functools.lru_cache(maxsize=128)
+def board_svg(placement,last_move,size,flipped):
+    svg = chess.svg.board(board=chess.BaseBoard(placement),
+                          lastmove=last_move,
+                          size=size,
+                          flipped=flipped)
+    return SVG_NEWLINE_REGEX.sub(' ', svg)
+
+@functools.lru_cache(maxsize=None)
+def board_text_template():
+    """
+    Return the text board with every square empty, as UTF-8 bytes, and the
+    byte offset of each square's cell within it.
+    """
+    text = bytearray(BOARD_TEXT_TOP)
+    offsets = [0] * len(chess.SQUARES)
+    for rank_index in reversed(range(8)):
+        if rank_index < 7:
+            text += BOARD_TEXT_MIDDLE
+        text += f'\\n{rank_index + 1}'.encode()
+        for file_index in range(8):
+            text += BOARD_TEXT_CELL
+            offsets[chess.square(file_index, rank_index)] = len(text)
+            text += b' '
+        text += BOARD_TEXT_CELL
+    text += BOARD_TEXT_BOTTOM
+    return bytes(text), offsets
+
+def pgn_to_board_callback(_headers,board,last_move,last_fen,args):
+    if args.board_format == 'svg':
+        svg = board_svg(board.board_fen(), last_move, args.pixels, args.flipped)
         return f':board-svg {svg}'
-    elif args.board_format[0] == 'text':
-        text = board.unicode(borders=True)
-        text = re.sub(r'·', ' ', text)
-        text = re.sub(r'-----------------', '├───┼───┼───┼───┼───┼───┼───┼───┤', text)
-        text = re.sub(r'\A  ├───┼───┼───┼───┼───┼───┼───┼───┤', '  ┌───┬───┬───┬───┬───┬───┬───┬───┐', text)
-        text = re.sub(r'├───┼───┼───┼───┼───┼───┼───┼───┤\n   a', '└───┴───┴───┴───┴───┴───┴───┴───┘\n   a', text)
-        text = re.sub( r'a b c d e f g h',   ' a   b   c   d   e   f   g   h',   text)
-        text = re.sub(r'\|', ' │ ', text)
-        text = re.sub(r'^(\d) ', '\\1', text, flags=re.MULTILINE)
-        text = text.translate(str.maketrans('♖♘♗♕♔♙♜♞♝♛♚♟⭘','RNBQKPrnbqkp '))
-        text = re.sub(r'\n', '\\\\n', text)
-        return f':board-text {text}'
+    elif args.board_format == 'text':
+        template, offsets = board_text_template()
+        text = bytearray(template)
+        for square, piece in board.piece_map().items():
+            text[offsets[square]] = ord(piece.symbol())
+        return f':board-text {text.decode()}'
     else:
-        print(f'Bad pgn-mode -board_format value: {args.board_format[0]}', file=sys.stderr)
+        sys.stderr.write(f'Bad pgn-mode -board_format value: {args.board_format}\n')
         return None
 
-def pgn_to_fen_callback(_game,board,_last_move,_last_fen,_args):
-    return f':fen {board.fen()}'
-
-def pgn_to_score_callback(_game,board,_last_move,_last_fen,args):
-    engine = instantiate_engine(args.engine[0])
-    uci_info = engine.analyse(board, chess.engine.Limit(depth=args.depth[0]))
-    return f':score {uci_info["score"]}'
-
-def pgn_to_mainline_callback(game,_board,_last_move,_last_fen,_args):
-    clean_exporter = chess.pgn.StringExporter(columns=None,
-                                              headers=False,
-                                              variations=False,
-                                              comments=False)
-    mainline = game.accept(clean_exporter)
-    mainline = re.sub(r'\s+\S+\Z', '', mainline)
+def pgn_to_svg_callback(headers,board,last_move,last_fen,args):
+    args.board_format = 'svg'
+    return pgn_to_board_callback(headers,board,last_move,last_fen,args)
+
+def pgn_to_fen_callback(_headers,board,_last_move,_last_fen,_args):
+    return f':fen {board_fen(board)}'
+
+def pgn_to_score_callback(_headers,board,_last_move,_last_fen,args):
+    key = (args.engine, args.depth, board._transposition_key())
+    if key in SCORE_CACHE:
+        SCORE_CACHE.move_to_end(key)
+    else:
+        with engine_lock(args.engine):
+            engine = instantiate_engine(args.engine)
+            uci_info = engine.analyse(board, chess.engine.Limit(depth=args.depth))
+        SCORE_CACHE[key] = uci_info["score"]
+        if len(SCORE_CACHE) > SCORE_CACHE_SIZE:
+            SCORE_CACHE.popitem(last=False)
+    return f':score {SCORE_CACHE[key]}'
+
+def pgn_to_mainline_callback(headers,board,_last_move,_last_fen,_args):
+    san_board = board.root()
+    tokens = []
+    for move in board.move_stack:
+        if san_board.turn == chess.WHITE:
+            tokens.append(f'{san_board.fullmove_number}.')
+        elif not tokens:
+            tokens.append(f'{san_board.fullmove_number}...')
+        tokens.append(san_board.san_and_push(move))
+    mainline = ' '.join(tokens) or headers.get('Result', '*')
     return f':san {mainline}'
 
 # todo should all responses be in sexp form?
-def pgn_to_last_move_info_callback(_game,_board,last_move,last_fen,_args):
+def pgn_to_last_move_info_callback(_headers,_board,last_move,last_fen,_args):
     return f':last-move-info (:fen "{shlex.quote(last_fen)}" :move-uci "{shlex.quote(last_move.uci())}")'
 
 def listen():
@@ -109,8 +405,6 @@ def listen():
     Listen for messages on stdin and send response data on stdout.
     """
 
-    argparser = generate_argparser()
-
     while True:
         input_str = sys.stdin.readline()
 
@@ -124,9 +418,9 @@ def listen():
             continue
 
         # Parse request.
-        match = re.compile(r'\A:version\s+(\S+)\s+(:\S+)(.*?)\s+--\s+(:\S+)\s+(\S.*)\n').search(input_str)
+        match = REQUEST_REGEX.search(input_str)
         if not match:
-            print(f'Bad pgn-mode server request. Could not parse: {input_str}', file=sys.stderr)
+            sys.stderr.write(f'Bad pgn-mode server request. Could not parse: {input_str}\n')
             continue
         [req_version,
          req_command,
@@ -135,77 +429,97 @@ def listen():
          req_payload] = match.groups()
 
         if not req_version == __version__:
-            print(f'Bad request: version mismatch: {req_version}', file=sys.stderr)
+            sys.stderr.write(f'Bad request: version mismatch: {req_version}\n')
             continue
 
         # Command code for handling input.
         if req_command not in CALLBACKS:
-            print(f'Bad request command (unknown): {req_command}', file=sys.stderr)
+            sys.stderr.write(f'Bad request command (unknown): {req_command}\n')
             continue
 
         # Options to modify operation of the command.
         try:
-            args = argparser.parse_args(shlex.split(req_options))
-        except:
-            print(f'Bad request options: {req_options}', file=sys.stderr)
+            args = parse_options(req_options)
+        except ValueError:
+            sys.stderr.write(f'Bad request options: {req_options}\n')
             continue
 
         # :payload-type is for future extensibility, currently always :pgn
         if not req_payload_type == ':pgn':
-            print(f'Bad request :payload-type (unknown): {req_payload_type}', file=sys.stderr)
+            sys.stderr.write(f'Bad request :payload-type (unknown): {req_payload_type}\n')
             continue
 
         # Build game board.
         pgn = req_payload
-        pgn = re.sub(r'\\n', '\n', pgn)
+        pgn = pgn.replace('\\n', '\n')
         pgn = pgn + '\n\n'
-        game = chess.pgn.read_game(io.StringIO(pgn))
-        board = game.board()
-        last_move = False
-        last_fen = board.fen()
-        for move in game.mainline_moves():
-            last_move = move
-            last_fen = board.fen()
-            board.push(move)
+        headers, board, last_move, last_fen = replay_pgn(pgn)
 
         # Compute response.
-        response = CALLBACKS[req_command](game,board,last_move,last_fen,args)
+        response = CALLBACKS[req_command](headers,board,last_move,last_fen,args)
 
         # Send response to client.
         if response:
-            print(f':version {__version__} {response}')
+            sys.stdout.write(f':version {__version__} {response}\n')
+            sys.stdout.flush()
 
 ###
 ### argument processing
 ###
 
-def generate_argparser():
-    argparser = argparse.ArgumentParser()
-    argparser.add_argument('-pixels', '--pixels',
-                           metavar='PIXELS',
-                           nargs=1,
-                           type=int,
-                           default=[400],
-                           help='set pixel-per-side for the SVG board output. Default is 400.')
-    argparser.add_argument('-board_format', '--board_format',
-                           nargs=1,
-                           type=str,
-                           default=['svg'],
-                           help='format for board output.  Default is "svg".')
-    argparser.add_argument('-engine', '--engine',
-                           nargs=1,
-                           type=str,
-                           default=['stockfish'],
-                           help='set path to UCI engine for analysis. Default is "stockfish".')
-    argparser.add_argument('-depth', '--depth',
-                           nargs=1,
-                           type=int,
-                           default=[10],
-                           help='set depth for depth-limited to UCI evaluations. Default is 10.')
-    argparser.add_argument('-flipped', '--flipped',
-                           action='store_true',
-                           help='display board flipped (Black perspective).')
-    return argparser
+# Request options, mapped to their type and default value.
+REQUEST_OPTIONS = {
+    # pixel-per-side for the SVG board output
+    'pixels': (int, 400),
+    # format for board output, "svg" or "text"
+    'board_format': (str, 'svg'),
+    # path to UCI engine for analysis
+    'engine': (str, 'stockfish'),
+    # depth for depth-limited UCI evaluations
+    'depth': (int, 10),
+}
+
+# Request flags, which take no value and default to False.
+REQUEST_FLAGS = {
+    # display board flipped (Black perspective)
+    'flipped',
+}
+
+def parse_options(options):
+    """
+    Parse request options such as '-pixels=400 -board_format svg -flipped'.
+    Raise ValueError for unknown or malformed options.
+    """
+    # Values are only quoted when they contain unusual characters, so the
+    # shell-like lexer is rarely needed.
+    if OPTIONS_QUOTING_REGEX.search(options):
+        tokens = shlex.split(options)
+    else:
+        tokens = options.split()
+
+    args = types.SimpleNamespace(**{name: default for name, (_, default) in REQUEST_OPTIONS.items()})
+    for name in REQUEST_FLAGS:
+        setattr(args, name, False)
+
+    tokens = iter(tokens)
+    for token in tokens:
+        if token.startswith('--'):
+            name, equals, value = token[2:].partition('=')
+        elif token.startswith('-'):
+            name, equals, value = token[1:].partition('=')
+        else:
+            raise ValueError(f'unexpected argument: {token}')
+        if name in REQUEST_FLAGS and not equals:
+            setattr(args, name, True)
+        elif name in REQUEST_OPTIONS:
+            if not equals:
+                value = next(tokens, None)
+                if value is None:
+                    raise ValueError(f'missing value for option: {token}')
+            setattr(args, name, REQUEST_OPTIONS[name][0](value))
+        else:
+            raise ValueError(f'unknown option: {token}')
+    return args
 
 ###
 ### main
@@ -224,6 +538,7 @@ if __name__ == '__main__':
     CALLBACKS = {
         ':pgn-to-fen': pgn_to_fen_callback,
         ':pgn-to-board': pgn_to_board_callback,
+        ':pgn-to-svg': pgn_to_svg_callback,
         ':pgn-to-score': pgn_to_score_callback,
         ':pgn-to-mainline': pgn_to_mainline_callback,
         ':pgn-to-last-move-info': pgn_to_last_move_info_callback,
@@ -231,7 +546,10 @@ if __name__ == '__main__':
 
     atexit.register(cleanup)
 
-    print(f'Server started.')
+    prewarm_engines()
+
+    sys.stdout.write('Server started.\n')
+    sys.stdout.flush()
 
     listen()
 